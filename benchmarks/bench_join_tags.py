@@ -0,0 +1,111 @@
+#!/usr/bin/env python2.7
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Benchmark CompiledWordTemplate._join_tags on synthetic documents of
+    increasing size, against the original character-by-character version.
+
+    The time per page should stay flat as the page count goes up.
+
+        python benchmarks/bench_join_tags.py [--pages 5,10,25,50,100]
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import os
+import sys
+import timeit
+
+from lxml import etree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), os.path.join(ROOT, 'src', 'plugins')]
+
+from resume_word import CompiledWordTemplate
+from synthetic import make_document, W
+
+
+def join_tags_reference(template, my_etree):
+    """The original _join_tags, for comparison"""
+    chars = []
+    openbrac = False
+    inside_openbrac_node = False
+
+    for node,text in template._itertext(my_etree):
+        for i,c in enumerate(text):
+            if c == '[':
+                openbrac = True
+                inside_openbrac_node = True
+                openbrac_node = node
+                chars = []
+            elif c== ']':
+                assert openbrac
+                if inside_openbrac_node:
+                    pass
+                else:
+                    chars.append(']')
+                    openbrac_node.text += ''.join(chars)
+                    node.text = text[i+1:]
+                openbrac = False
+                inside_openbrac_node = False
+            else:
+                if openbrac and not inside_openbrac_node:
+                    chars.append(c)
+        if openbrac and not inside_openbrac_node:
+            node.text = ""
+        inside_openbrac_node = False
+
+
+def time_join(join, doc, repeat):
+    """Best time in seconds of join over fresh copies of doc"""
+    best = None
+    for _ in range(repeat):
+        d = copy.deepcopy(doc)
+        start = timeit.default_timer()
+        join(d)
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='bench_join_tags.py')
+    p.add_argument('--pages', default='5,10,25,50,100',
+        help='Comma separated document sizes in pages')
+    p.add_argument('--repeat', type=int, default=5)
+    args = p.parse_args(argv)
+
+    template = CompiledWordTemplate.load(os.path.join(ROOT, 'templates', 'word_resume.docx'))
+
+    print('%6s %8s %12s %12s %14s' % ('pages', 'runs', 'join ms', 'ms/page', 'reference ms'))
+    for pages in [int(x) for x in args.pages.split(',')]:
+        doc = make_document(pages)
+
+        # Both versions have to produce the same document
+        new, ref = copy.deepcopy(doc), copy.deepcopy(doc)
+        template._join_tags(new)
+        join_tags_reference(template, ref)
+        assert etree.tostring(new) == etree.tostring(ref), "Output differs at %d pages" % pages
+
+        runs = len(doc.findall('.//{%s}r' % W))
+        t_new = time_join(template._join_tags, doc, args.repeat)
+        t_ref = time_join(lambda d: join_tags_reference(template, d), doc, args.repeat)
+        print('%6d %8d %12.2f %12.3f %14.2f' % (pages, runs, t_new * 1000,
+                                                t_new * 1000 / pages, t_ref * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,180 @@
+#!/usr/bin/env python2.7
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Benchmark WordResume and TextResume on synthetic resumes and templates of
+    increasing size (see synthetic.py), reporting for each size the renders
+    per second, the mean time per render and each stage of it (as recorded
+    by --timings), the template compile time and the peak memory.
+
+    Each case runs in a fresh process so its peak memory is its own.  Save
+    the results with --save and compare a later run against them with
+    --compare, e.g. before and after a change:
+
+        python benchmarks/bench_render.py --save before.json
+        python benchmarks/bench_render.py --compare before.json
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), os.path.join(ROOT, 'src', 'plugins')]
+
+import timing
+from resume_word import WordResume
+from resume_text import TextResume
+from synthetic import make_resume, make_word_template, make_mako_template
+
+PLUGINS = OrderedDict([('Word', (WordResume, make_word_template, '.docx')),
+                       ('Text', (TextResume, lambda f, sections, seed: make_mako_template(f, sections), '.mako'))])
+
+
+def _peak_rss_kb():
+    # Kilobytes on Linux (bytes on OS X, where this is only roughly comparable)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(case):
+    """
+        Time case['repeat'] renders of one plugin and size, in this process.
+        Returns the case with its results filled in.
+    """
+    plugin, make_template, ext = PLUGINS[case['plugin']]
+    rss_before = _peak_rss_kb()
+    tmp_dir = tempfile.mkdtemp(prefix='oneresume_bench')
+    try:
+        template_filename = os.path.join(tmp_dir, 'template' + ext)
+        make_template(template_filename, sections=case['sections'], seed=0)
+        resume = make_resume(case['sections'], case['entries'], case['words'])
+
+        start = timeit.default_timer()
+        plugin.load_template(template_filename)
+        compile_time = timeit.default_timer() - start
+
+        stages = OrderedDict()
+        times = []
+        output_size = 0
+        for _ in range(case['repeat']):
+            output = io.BytesIO()
+            timings = timing.start()
+            start = timeit.default_timer()
+            plugin(template_filename, resume, False).render(output)
+            times.append(timeit.default_timer() - start)
+            timing.stop()
+            for name, seconds in timings.stages.items():
+                stages[name] = stages.get(name, 0.0) + seconds
+            output_size = len(output.getvalue())
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    mean = sum(times) / len(times)
+    result = dict(case)
+    result.update(renders_per_sec=1.0 / mean,
+                  mean_ms=mean * 1000,
+                  best_ms=min(times) * 1000,
+                  compile_ms=compile_time * 1000,
+                  peak_rss_kb=_peak_rss_kb() - rss_before,
+                  output_bytes=output_size,
+                  stages_ms=OrderedDict((name, seconds * 1000 / len(times))
+                                        for name, seconds in stages.items()))
+    return result
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _key(result):
+    return (result['plugin'], result['sections'], result['entries'], result['words'])
+
+
+def print_results(results, baseline=None):
+    previous = dict((_key(r), r) for r in (baseline or {}).get('results', []))
+    print('%-5s %8s %8s %10s %10s %10s %10s  %s' % ('', 'sections', 'entries', 'renders/s',
+                                                    'mean ms', 'compile ms', 'peak KB', 'stages (ms)'))
+    for r in results:
+        line = '%-5s %8d %8d %10.1f %10.2f %10.2f %10d  %s' % (
+            r['plugin'], r['sections'], r['entries'], r['renders_per_sec'], r['mean_ms'],
+            r['compile_ms'], r['peak_rss_kb'],
+            ' '.join('%s=%.2f' % item for item in r['stages_ms'].items()
+                        if item[0] != 'template_load'))
+        print(line)
+        old = previous.get(_key(r))
+        if old:
+            print('%-5s %8s %8s %10s %9.2fx %9.2fx %9.2fx' % (
+                '', '', 'vs base', '', r['mean_ms'] / old['mean_ms'],
+                r['compile_ms'] / old['compile_ms'],
+                float(r['peak_rss_kb']) / old['peak_rss_kb'] if old['peak_rss_kb'] else 0))
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='bench_render.py')
+    p.add_argument('--plugins', default=','.join(PLUGINS),
+        help='Comma separated plugins to run (default %(default)s)')
+    p.add_argument('--entries', default='10,100,1000',
+        help='Comma separated entries per section (default %(default)s)')
+    p.add_argument('--sections', type=int, default=5)
+    p.add_argument('--words', type=int, default=30,
+        help='Words in each entry summary (default %(default)s)')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--save', default=None, metavar='FILE',
+        help='Write the results to FILE as JSON')
+    p.add_argument('--compare', default=None, metavar='FILE',
+        help='Show how the results compare with ones saved earlier')
+    args = p.parse_args(argv)
+
+    cases = [{'plugin': plugin, 'sections': args.sections, 'entries': int(entries),
+              'words': args.words, 'repeat': args.repeat}
+             for plugin in args.plugins.split(',')
+             for entries in args.entries.split(',')]
+    # One process per case, so peak memory isn't carried over from the last one
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = pool.map(run_case, cases, chunksize=1)
+    pool.close()
+    pool.join()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('Comparing %s with %s' % (get_version(), baseline.get('version')))
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'version': get_version(),
+                       'python': platform.python_version(),
+                       'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python2.7
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Compare the streaming Word renderer (the 'streaming' output option) with
+    the in-memory one on synthetic resumes of increasing size: check that
+    they write exactly the same word/document.xml, and show the time and
+    peak memory of each.  Streaming's peak memory should stay about flat.
+
+        python benchmarks/bench_streaming.py [--entries 100,1000,10000]
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import timeit
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), os.path.join(ROOT, 'src', 'plugins')]
+
+from resume_word import WordResume
+from synthetic import make_resume, make_word_template
+
+
+def get_plugin(template_filename, resume, streaming):
+    return WordResume(template_filename, resume, False, {'streaming': streaming})
+
+
+def run_case(case):
+    """
+        Render once with one of the renderers, in this process, to a file
+        so the output doesn't count towards memory.  Returns (seconds, peak
+        RSS growth in KB).
+    """
+    template_filename, sections, entries, streaming = case
+    resume = make_resume(sections, entries)
+    WordResume.load_template(template_filename)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    get_plugin(template_filename, resume, streaming).render(template_filename + '.out.docx')
+    elapsed = timeit.default_timer() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+
+def get_document(docx_bytes):
+    return zipfile.ZipFile(io.BytesIO(docx_bytes)).read('word/document.xml')
+
+
+def main(argv):
+    p = argparse.ArgumentParser(prog='bench_streaming.py')
+    p.add_argument('--entries', default='100,1000,10000',
+        help='Comma separated entries per section (default %(default)s)')
+    p.add_argument('--sections', type=int, default=5)
+    args = p.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix='oneresume_bench')
+    try:
+        template_filename = os.path.join(tmp_dir, 'template.docx')
+        make_word_template(template_filename, args.sections)
+
+        print('%8s %12s %12s %12s %12s %12s' % ('entries', 'xml KB', 'memory ms', 'memory KB',
+                                                'stream ms', 'stream KB'))
+        for entries in [int(x) for x in args.entries.split(',')]:
+            # Both renderers have to produce the same document
+            resume = make_resume(args.sections, entries)
+            in_memory = get_document(get_plugin(template_filename, resume, False).render_bytes())
+            streamed = get_document(get_plugin(template_filename, resume, True).render_bytes())
+            assert in_memory == streamed, "Streamed document differs at %d entries" % entries
+
+            # A fresh process for each, so peak memory isn't carried over
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            (t_memory, kb_memory), (t_stream, kb_stream) = pool.map(
+                run_case, [(template_filename, args.sections, entries, streaming)
+                           for streaming in (False, True)], chunksize=1)
+            pool.close()
+            pool.join()
+            print('%8d %12d %12.1f %12d %12.1f %12d' % (entries, len(in_memory) // 1024,
+                    t_memory * 1000, kb_memory, t_stream * 1000, kb_stream))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Generators for synthetic resumes and templates of any size, for the
+    benchmarks.  Everything is seeded, so the same arguments always give
+    the same output.
+"""
+
+import os
+import random
+import zipfile
+
+from lxml import etree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+WORD_TEMPLATE = os.path.join(ROOT, 'templates', 'word_resume.docx')
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+PARAGRAPHS_PER_PAGE = 40
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua').split()
+
+# Keys of every entry in a synthetic resume section
+FIELDS = ('title', 'place', 'date', 'summary')
+
+
+def _add_runs(paragraph, text, rnd):
+    """Split text into runs at random points, the way Word does after edits"""
+    cuts = sorted(rnd.sample(range(1, len(text)), min(3, len(text) - 1)))
+    for start, end in zip([0] + cuts, cuts + [len(text)]):
+        run = etree.SubElement(paragraph, '{%s}r' % W)
+        etree.SubElement(run, '{%s}t' % W).text = text[start:end]
+
+
+def _words(rnd, count):
+    return ' '.join(rnd.choice(WORDS) for _ in range(count))
+
+
+def make_document(pages, seed=0):
+    """A w:document with pages * PARAGRAPHS_PER_PAGE paragraphs, a third of them with tags"""
+    rnd = random.Random(seed)
+    doc = etree.Element('{%s}document' % W, nsmap={'w': W})
+    body = etree.SubElement(doc, '{%s}body' % W)
+    for i in range(pages * PARAGRAPHS_PER_PAGE):
+        words = [rnd.choice(WORDS) for _ in range(12)]
+        if i % 3 == 0:
+            words.insert(rnd.randrange(len(words)), '[tag_%d]' % i)
+        if i % 7 == 0:
+            words.insert(rnd.randrange(len(words)), '<[sub_%d] and [other_%d]>' % (i, i))
+        _add_runs(etree.SubElement(body, '{%s}p' % W), ' '.join(words), rnd)
+    return doc
+
+
+def section_names(sections):
+    return ['section_%d' % i for i in range(sections)]
+
+
+def make_resume(sections=5, entries=10, words=30, seed=0):
+    """
+        A resume dict with the given number of sections, each a list of
+        entries whose summary is the given number of words long
+    """
+    rnd = random.Random(seed)
+    resume = {}
+    for name in section_names(sections):
+        resume[name] = [{'title': _words(rnd, 3).title(),
+                         'place': _words(rnd, 2).title(),
+                         'date': '%d-%d' % (1990 + i % 30, 1991 + i % 30),
+                         'summary': _words(rnd, words)}
+                        for i in range(entries)]
+    return resume
+
+
+def make_word_template(filename, sections=5, seed=0):
+    """
+        Write a .docx template for a make_resume resume to filename.  It keeps
+        the styles and settings of the shipped template, with its body
+        replaced by a heading and a two paragraph loop for each section.
+    """
+    rnd = random.Random(seed)
+    with zipfile.ZipFile(WORD_TEMPLATE) as template_zip:
+        doc = etree.fromstring(template_zip.read('word/document.xml'))
+        body = doc.find('{%s}body' % W)
+        # Keep the section properties, which have to stay last
+        sect_pr = body.find('{%s}sectPr' % W)
+        for child in list(body):
+            body.remove(child)
+        for name in section_names(sections):
+            for text in ('[%s]' % name, '<[title], [place] ([date])', '[summary]>'):
+                _add_runs(etree.SubElement(body, '{%s}p' % W), text, rnd)
+        if sect_pr is not None:
+            body.append(sect_pr)
+
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as out:
+            for info in template_zip.infolist():
+                if info.filename == 'word/document.xml':
+                    out.writestr(info, etree.tostring(doc, xml_declaration=True,
+                                                      encoding='UTF-8', standalone=True))
+                else:
+                    out.writestr(info, template_zip.read(info.filename))
+
+
+def make_mako_template(filename, sections=5):
+    """
+        Write a text template for a make_resume resume to filename
+    """
+    lines = []
+    for name in section_names(sections):
+        lines += ['%s:' % name.upper(),
+                  '-' * (len(name) + 1),
+                  "% for e in d['" + name + "']:",
+                  "  ${e['title']}, ${e['place']} (${e['date']})",
+                  "    ${s._wrap(2, e['summary'])}",
+                  '',
+                  '% endfor',
+                  '']
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines))
@@ -24,9 +24,25 @@ from __future__ import print_function
 
 import argparse
 import sys, os
+import base64
 import logging
+import multiprocessing
+import signal
+import time
+import shutil
+import collections
+import traceback
+import cProfile
+import hashlib
+import json
 import yaml
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
 from plugin import Plugin
+from resume_cache import ResumeCache, YamlLoader
+import timing
 
 
 def error(text):
@@ -34,17 +50,295 @@ def error(text):
     sys.exit(-1)
 
 
+class RenderError(Exception):
+    pass
+
+
+DEFAULT_MANIFEST = '.oneresume_manifest.json'
+
+def parse_shard(text):
+    """
+        Return (index, count) from 'INDEX/COUNT'
+    """
+    try:
+        index, count = [int(x) for x in text.split('/')]
+    except ValueError:
+        error("--shard must be INDEX/COUNT, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        error("--shard index must be from 0 to %d" % (count - 1))
+    return (index, count)
+
+def get_shard(output_filename, count):
+    """
+        The shard an output belongs in.  This only depends on the output's
+        path, so every machine splits a config up the same way.
+    """
+    output_hash = hashlib.sha1(os.path.normpath(output_filename).encode('utf-8')).hexdigest()
+    return int(output_hash[:8], 16) % count
+
+def save_summary(summary, summary_filename):
+    tmp_filename = summary_filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    os.rename(tmp_filename, summary_filename)
+
+def print_summary(summary):
+    print ("Rendered %d, copied %d identical, skipped %d up to date, failed %d" % (
+                len(summary['rendered']), len(summary.get('copied', [])),
+                len(summary['skipped']), len(summary['failed'])))
+
+
+def read_config(config_file):
+    """
+        Yield the entries of a batch config file one at a time, closing it
+        at the end.  A .jsonl file has one JSON entry per line.  A YAML file
+        can be a list of entries, or several '---' separated documents of
+        entries (or lists of them) which are only parsed as they're needed.
+
+        Each entry comes as (where, entry, error), where says where in the
+        file it is.  Anything that can't be parsed is yielded with an error
+        message instead of raising, so the entries before it still get
+        rendered.  A bad .jsonl line is skipped, but YAML can't be read past
+        an error, so that ends the config.
+    """
+    with config_file:
+        if config_file.name.endswith(('.jsonl', '.ndjson')):
+            for line_number, line in enumerate(config_file, 1):
+                if not line.strip():
+                    continue
+                where = '%s line %d' % (config_file.name, line_number)
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    yield (where, None, "Invalid JSON: %s" % e)
+                else:
+                    yield (where, entry, None)
+            return
+
+        docs = yaml.load_all(config_file, Loader=YamlLoader)
+        doc_number = 0
+        while True:
+            doc_number += 1
+            where = '%s document %d' % (config_file.name, doc_number)
+            try:
+                doc = next(docs)
+            except StopIteration:
+                return
+            except yaml.YAMLError as e:
+                yield (where, None, "Invalid YAML: %s" % e)
+                return
+            if isinstance(doc, list):
+                for entry_number, entry in enumerate(doc, 1):
+                    yield ('%s, entry %d' % (where, entry_number), entry, None)
+            elif doc is not None:
+                yield (where, doc, None)
+
+
+# Parsed resumes in this process, so that several outputs from the
+# same data file don't each re-read it
+resume_cache = ResumeCache()
+
+# Relative to this file rather than sys.argv[0], so that OneResume
+# can also be imported and used as a library
+PLUGINS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plugins')
+
+def init_worker(cache_dir):
+    """
+        Set up a worker process of a parallel batch the way OneResume sets
+        up the main one.  Workers that are started fresh rather than forked
+        (the 'spawn' start method) have none of the main process's state.
+    """
+    # Forked workers would otherwise inherit run_rendering's SIGTERM handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if not Plugin.available:
+        Plugin.load(PLUGINS_DIR)
+    resume_cache.cache_dir = cache_dir
+    Plugin.cache_dir = cache_dir
+
+def load_resume(data_filename):
+    return resume_cache.load(data_filename)
+
+def get_plugin(fmt, template_file):
+    """
+        Return the plugin class for format fmt, checking that template_file
+        is the right type for it
+    """
+    if not Plugin.available:
+        # A process that OneResume wasn't set up in, e.g. a spawned worker
+        Plugin.load(PLUGINS_DIR)
+    # Check that we have a plugin for this format
+    plugin_name = '%sResume' % fmt
+    if plugin_name not in Plugin.available:
+        raise RenderError("Format %s is not one of following: %s" % (fmt,
+                            ' '.join(p.split('Resume')[0] for p in Plugin.available)))
+    # Check the template before importing the plugin
+    extension = Plugin.available[plugin_name].template_file_extension
+    filebasename,filetype = os.path.splitext(template_file)
+    if filetype[1:] != extension:
+        raise RenderError("File type/extension %s is not %s" % (filetype, extension))
+    return Plugin.get(plugin_name)
+
+def render_job(job):
+    """
+        Run one (data, output) conversion described by the job dict.
+        Returns (output filename, error message or None, stage timings or
+        None), so a failing job never stops the rest of the batch.  This is
+        module-level so that it can be handed to worker processes.
+
+        With job['timings'] set, the time spent in each stage is recorded,
+        and with job['profile_dir'] set the render is run under cProfile.
+    """
+    timings = timing.start() if job.get('timings') else None
+    profiler = None
+    if job.get('profile_dir'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start_time = timing.timer()
+    try:
+        if job.get('error'):
+            # A bad entry in the config (see OneResume.get_jobs)
+            raise RenderError(job['error'])
+        if job['data'] is None:
+            # Check that the yaml resume file is specified
+            raise RenderError("Configuration file has not defined 'data' with resume yaml file")
+        plugin = get_plugin(job['format'], job['template'])
+        with timing.stage('yaml_load'):
+            resume = load_resume(job['data'])
+        # Instantiate the required conversion plugin
+        with timing.stage('template_load'):
+            text = plugin(job['template'], resume, job['skip'], job['options'])
+        if os.path.exists(job['output']) and os.stat(job['output']).st_nlink > 1:
+            # Don't write through a hard link to another output (see copy_output)
+            os.remove(job['output'])
+        with timing.stage('render'):
+            text.render(job['output'])
+        err = None
+    except Exception as e:
+        logging.debug(traceback.format_exc())
+        err = str(e) or e.__class__.__name__
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(_get_profile_filename(job))
+        timing.stop()
+    if timings is None:
+        return (job['output'], err, None)
+    timings.add('total', timing.timer() - start_time)
+    return (job['output'], err, timings.stages)
+
+def _get_profile_filename(job):
+    """
+        One .prof file per output, named after its path so that outputs with
+        the same name in different directories don't collide
+    """
+    name = os.path.normpath(job['output']).strip(os.sep).replace(os.sep, '_')
+    return os.path.join(job['profile_dir'], name + '.prof')
+
+def copy_output(job, failed):
+    """
+        Make job's output from the identical output job['duplicate_of'], which
+        has already been rendered, by hard linking to it or else copying it.
+        Returns the same as render_job.
+    """
+    source = job['duplicate_of']
+    if source in failed:
+        return (job['output'], "Not copied from %s, which failed" % source, None)
+    if source == job['output']:
+        return (job['output'], None, None)
+    try:
+        if os.path.exists(job['output']):
+            os.remove(job['output'])
+        try:
+            os.link(source, job['output'])
+        except (OSError, AttributeError):
+            # Another filesystem, or no hard links here
+            shutil.copyfile(source, job['output'])
+    except (IOError, OSError) as e:
+        return (job['output'], str(e), None)
+    return (job['output'], None, None)
+
+def handle_request(request):
+    """
+        Run one conversion sent to the server, and return the response dict.
+
+        The request has 'format' and 'template', the resume as either a 'data'
+        filename or an inline 'resume' dict, and optionally 'skip' and plugin
+        'options'.  With an 'output' filename the document is written there,
+        otherwise it comes back base64 encoded in 'bytes'.  Any 'id' is
+        copied to the response.
+    """
+    response = {'id': request.get('id')}
+    try:
+        for key in ('format', 'template'):
+            if key not in request:
+                raise RenderError("Request is missing '%s'" % key)
+        plugin = get_plugin(request['format'], request['template'])
+        if 'resume' in request:
+            resume = request['resume']
+        elif 'data' in request:
+            resume = load_resume(request['data'])
+        else:
+            raise RenderError("Request has neither 'data' nor 'resume'")
+        text = plugin(request['template'], resume, request.get('skip', False),
+                        request.get('options'))
+        if request.get('output'):
+            text.render(request['output'])
+            response['output'] = request['output']
+        else:
+            response['bytes'] = base64.b64encode(text.render_bytes()).decode('ascii')
+        response['ok'] = True
+    except Exception as e:
+        logging.debug(traceback.format_exc())
+        response.update(ok=False, error=str(e) or e.__class__.__name__)
+    return response
+
+def serve_lines(lines, write):
+    """
+        Answer each JSON request line from lines with one JSON response line
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'id': None, 'ok': False, 'error': "Bad request: %s" % e}
+        else:
+            if isinstance(request, dict):
+                response = handle_request(request)
+            else:
+                response = {'id': None, 'ok': False, 'error': "Request must be a JSON object"}
+        write(json.dumps(response) + '\n')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        def write(text):
+            self.wfile.write(text.encode('utf-8'))
+            self.wfile.flush()
+        serve_lines(iter(self.rfile.readline, b''), write)
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # A thread per connection, so a client that keeps its connection open
+    # for many requests doesn't hold up the others
+    daemon_threads = True
+
+
 class OneResume(object):
 
     def __init__ (self):
         #Plugin.load("plugins/")
-        script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-        Plugin.load(os.path.join(script_dir,"plugins"))
+        Plugin.load(PLUGINS_DIR)
         self.allowed_filetypes = []
         self.allowed_formats = []
-        for p, p_class in Plugin.registered.items():
-            print("Registered output plugin type %s" % p)
-            self.allowed_filetypes.append(p_class.template_file_extension)
+        # Plugins are only imported when first used, so go by what Plugin.load read of them
+        for p, info in Plugin.available.items():
+            self.allowed_filetypes.append(info.template_file_extension)
             self.allowed_formats.append(p.split('Resume')[0])
 
     def getOptions(self, argv):
@@ -57,6 +351,12 @@ class OneResume(object):
             default=False, dest='verbose', help='Turn on verbose mode')
         p.add_argument('-s', '--skip-substitution', action='store_true',
             default=False, dest='skip', help='Skip the text substitution and just write out the template as is (useful for pretty-printing')
+        p.add_argument('--cache-dir', default=None,
+            help='Directory to keep parsed resume data and compiled templates in between runs')
+        p.add_argument('--timings', default=None, metavar='FILE',
+            help='Append the time spent in each stage of every render to FILE, as JSON lines')
+        p.add_argument('--profile', default=None, metavar='DIR', dest='profile_dir',
+            help='Run each render under cProfile and write DIR/<output>.prof')
 
         # Now split up the options on whether we just run one template rendering
         # or use a "batch" mode to read a yaml config file to run multiple
@@ -64,27 +364,65 @@ class OneResume(object):
                                         dest = "subparser_name")
 
         parser_singlefile = subparsers.add_parser('single', help='Run a single conversion')
-        parser_singlefile.add_argument('-t', '--template-file', required=True, 
-            help='Template filename %s' % self.allowed_filetypes)
-        parser_singlefile.add_argument('-y', '--yaml-resume-file', required=True, 
-            help='Resume yaml filename')
-        parser_singlefile.add_argument('-o', '--output-file', required=True, 
-            help='Output filename')
-        parser_singlefile.add_argument('-f', '--format', required=True, 
-            choices = self.allowed_formats,
-            help='Conversion type %s' % self.allowed_formats )
+        parser_watch = subparsers.add_parser('watch', help='Run a single conversion again whenever its resume or template changes')
+        for parser in (parser_singlefile, parser_watch):
+            parser.add_argument('-t', '--template-file', required=True, 
+                help='Template filename %s' % self.allowed_filetypes)
+            parser.add_argument('-y', '--yaml-resume-file', required=True, 
+                help='Resume yaml filename')
+            parser.add_argument('-o', '--output-file', required=True, 
+                help='Output filename')
+            parser.add_argument('-f', '--format', required=True, 
+                choices = self.allowed_formats,
+                help='Conversion type %s' % self.allowed_formats )
+        parser_watch.add_argument('--interval', type=float, default=0.2,
+            help='Seconds between checks for changes (default %(default)s)')
 
 
         parser_configfile = subparsers.add_parser('batch', help="Run multiple conversions using a yaml config file as input")
         parser_configfile.add_argument('-c', '--config-file', required=True, type=argparse.FileType('r'),
              help='configuration YAML filename ' )
+        parser_configfile.add_argument('-j', '--jobs', type=int, default=1,
+             help='Number of conversions to run in parallel (default 1)')
+        parser_configfile.add_argument('--manifest', default=None,
+             help='File recording what each output was built from, so unchanged outputs are skipped (default %s)' % DEFAULT_MANIFEST)
+        parser_configfile.add_argument('--force', action='store_true', default=False,
+             help='Render every output even if it is up to date')
+        parser_configfile.add_argument('--shard', default=None, metavar='INDEX/COUNT',
+             help='Only run the outputs in shard INDEX (counting from 0) of COUNT, so the batch can be split across machines')
+        parser_configfile.add_argument('--summary', default=None, metavar='FILE',
+             help='Write what was rendered, skipped and failed to FILE as JSON (see merge)')
+
+        parser_merge = subparsers.add_parser('merge', help="Combine the --summary files of the shards of a batch")
+        parser_merge.add_argument('summaries', nargs='+', metavar='SUMMARY',
+             help='Summary files to merge')
+        parser_merge.add_argument('-o', '--output', default=None,
+             help='Write the merged summary to this file')
+
 
+        parser_serve = subparsers.add_parser('serve', help="Keep running and render jobs sent as JSON lines on stdin or a Unix socket")
+        parser_serve.add_argument('--socket', default=None, dest='socket_path',
+             help='Listen on this Unix socket instead of reading stdin')
+        parser_serve.add_argument('-t', '--template-file', action='append', default=[], dest='preload',
+             help='Template to load before taking requests (can be given more than once)')
 
         args = p.parse_args(argv)
+        self.subparser_name = args.subparser_name
+
+        # In serve mode stdout carries the responses, so keep it clean
+        out = sys.stderr if args.subparser_name == 'serve' else sys.stdout
+        for p in Plugin.available:
+            print("Registered output plugin type %s" % p, file=out)
 
         self.debug = args.debug
         self.verbose = args.verbose
         self.skip = args.skip
+        resume_cache.cache_dir = args.cache_dir
+        Plugin.cache_dir = args.cache_dir
+        self.timings_filename = args.timings
+        self.profile_dir = args.profile_dir
+        if self.profile_dir and not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
 
         if args.debug:
             logging.basicConfig(level=logging.DEBUG, format='%(message)s')
@@ -92,60 +430,417 @@ class OneResume(object):
         if args.verbose:
             logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+        self.jobs = 1
+        self.manifest_filename = None
+        self.force = True
+        self.shard = None
+        self.summary_filename = None
         # Normal options
-        if args.subparser_name == 'single':
-            self.config = yaml.load("""-
-                                        data: %s
-                                        outputs:
-                                            - 
-                                                format: %s
-                                                template: %s
-                                                output: %s
-                                    """ % (args.yaml_resume_file, args.format, args.template_file, args.output_file ))
+        if args.subparser_name == 'merge':
+            self.summaries = args.summaries
+            self.merged_filename = args.output
+        elif args.subparser_name == 'serve':
+            self.socket_path = args.socket_path
+            self.preload = args.preload
+        elif args.subparser_name in ('single', 'watch'):
+            self.interval = getattr(args, 'interval', None)
+            # Built directly rather than as YAML, which a filename could break
+            self.config = [{'data': args.yaml_resume_file,
+                            'outputs': [{'format': args.format,
+                                         'template': args.template_file,
+                                         'output': args.output_file}]}]
         else:
             config_file = args.config_file
             logging.debug("Reading configuration file %s" % config_file)
-            self.config = yaml.load(config_file)
-            config_file.close()
+            # Read as the jobs are run, so a huge config doesn't have to fit in memory
+            self.config = read_config(config_file)
+            if args.jobs < 1:
+                error("--jobs must be at least 1")
+            self.jobs = args.jobs
+            self.force = args.force
+            self.summary_filename = args.summary
+            self.manifest_filename = args.manifest
+            if args.shard is not None:
+                self.shard = parse_shard(args.shard)
+            if self.manifest_filename is None:
+                self.manifest_filename = DEFAULT_MANIFEST
+                if self.shard is not None:
+                    # Shards can share a directory, so each keeps its own manifest
+                    self.manifest_filename = '.oneresume_manifest.%dof%d.json' % self.shard
+
+    def get_jobs(self):
+        """
+            Flatten self.config into one job dict per (data, output) conversion.
+            An entry without 'outputs' is a single output with its own 'data'.
+
+            An entry that's missing something becomes a job with an 'error',
+            named after its output if it has one, or else after where it is
+            in the config, so that it fails like any other job.
+        """
+        config = self.config
+        if isinstance(config, list):
+            # Made from the command line rather than by read_config
+            config = (('entry %d' % i, c, None) for i, c in enumerate(config, 1))
+
+        for where, c, err in config:
+            for job in self._get_entry_jobs(where, c, err):
+                if self.shard is not None and get_shard(job['output'], self.shard[1]) != self.shard[0]:
+                    continue
+                yield job
+
+    def _get_entry_jobs(self, where, c, err):
+        """
+            Yield the jobs for one config entry, from read_config
+        """
+        if err is None and not isinstance(c, dict):
+            err = "Entry has to be a mapping, not %s" % type(c).__name__
+        elif err is None and not isinstance(c.get('outputs', []), list):
+            err = "'outputs' has to be a list"
+        if err is not None:
+            yield self._get_failed_job(where, err)
+            return
+
+        for output_number, output in enumerate(c.get('outputs', [c]), 1):
+            if 'outputs' in c:
+                where_output = '%s, output %d' % (where, output_number)
+            else:
+                where_output = where
+            if not isinstance(output, dict):
+                yield self._get_failed_job(where_output, "Output has to be a mapping")
+                continue
+            missing = [key for key in ('format', 'template', 'output') if not output.get(key)]
+            if missing:
+                yield self._get_failed_job(where_output,
+                            "Missing %s" % ', '.join("'%s'" % key for key in missing),
+                            output.get('output'))
+                continue
+            yield {'data': c.get('data'),
+                   'format': output['format'],
+                   'template': output['template'],
+                   'output': output['output'],
+                   'skip': self.skip,
+                   'timings': self.timings_filename is not None,
+                   'profile_dir': self.profile_dir,
+                   # Anything else is passed on to the plugin
+                   'options': dict((k, v) for k, v in output.items()
+                                    if k not in ('data', 'format', 'template', 'output')),
+                  }
+
+    def _get_failed_job(self, where, err, output_filename=None):
+        """
+            A job for a bad config entry, which render_job reports as failed
+        """
+        if output_filename is None:
+            output_filename = where
+        else:
+            err = '%s: %s' % (where, err)
+        return {'data': None, 'format': None, 'template': None, 'output': output_filename,
+                'error': err, 'skip': self.skip, 'timings': False, 'profile_dir': None,
+                'options': {}}
+
+    def _load_manifest(self):
+        if self.manifest_filename is None or not os.path.exists(self.manifest_filename):
+            return {}
+        try:
+            with open(self.manifest_filename) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning("Ignoring unreadable manifest %s" % self.manifest_filename)
+            return {}
+
+    def _save_manifest(self, manifest):
+        if self.manifest_filename is None:
+            return
+        tmp_filename = self.manifest_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_filename, self.manifest_filename)
+
+    def _get_file_hash(self, filename, file_hashes):
+        if filename not in file_hashes:
+            with open(filename, 'rb') as f:
+                file_hashes[filename] = hashlib.sha1(f.read()).hexdigest()
+        return file_hashes[filename]
+
+    def _get_job_hash(self, job, file_hashes):
+        """
+            Hash of everything that goes into an output: the resume data and template
+            contents, the plugin and its version, the skip flag and any plugin
+            options.  None if the job can't be hashed (it will fail when
+            rendered anyway).
+        """
+        plugin = Plugin.available.get('%sResume' % job['format'])
+        if plugin is None or job['data'] is None:
+            return None
+        try:
+            parts = [self._get_file_hash(job['data'], file_hashes),
+                     self._get_file_hash(job['template'], file_hashes),
+                     job['format'], str(plugin.version), str(job['skip']),
+                     json.dumps(job['options'], sort_keys=True)]
+        except (IOError, OSError):
+            return None
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
 
     def run_rendering(self):
         """
-            Based on self.config, instantiate each plugin conversion and run it
+            Based on self.config, instantiate each plugin conversion and run it,
+            spreading the conversions over self.jobs processes.
+
+            Outputs whose inputs haven't changed since the manifest was
+            written are skipped, unless self.force is set.
         """
-        
-        if not isinstance(self.config, list):
-            # If the config was not a list, just convert this one element into a list
-            self.config = [self.config]
+        start_time = timing.timer()
+        manifest = self._load_manifest()
+        file_hashes = {}
+        skipped = []
+        # Job hash -> the first output with it, so identical jobs are only rendered once
+        first_outputs = {}
+
+        def get_pending():
+            for job in self.get_jobs():
+                job_hash = self._get_job_hash(job, file_hashes)
+                if (not self.force and job_hash is not None
+                        and manifest.get(job['output']) == job_hash
+                        and os.path.exists(job['output'])):
+                    logging.info("%s is up to date" % job['output'])
+                    skipped.append(job['output'])
+                    first_outputs.setdefault(job_hash, job['output'])
+                    continue
+                if job_hash is not None:
+                    if job_hash in first_outputs:
+                        job['duplicate_of'] = first_outputs[job_hash]
+                    else:
+                        first_outputs[job_hash] = job['output']
+                yield job, job_hash
+
+        timings_file = open(self.timings_filename, 'a') if self.timings_filename else None
+
+        # Results come back in job order, whatever order they finished in
+        rendered = []
+        copied = []
+        failed = {}
+        # So that a kill also saves the manifest below
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(-1))
+        try:
+            for job, job_hash, result in self._render_all(get_pending()):
+                if result is None:
+                    # The same as an earlier output, which is done by now
+                    result = copy_output(job, failed)
+                output_filename, err, stages = result
+                if timings_file and stages is not None:
+                    timings_file.write(json.dumps({'output': output_filename,
+                                                   'format': job['format'],
+                                                   'template': job['template'],
+                                                   'ok': err is None,
+                                                   'stages': stages}) + '\n')
+                if err is None and 'duplicate_of' in job:
+                    print ("Creating %s ... same as %s" % (output_filename, job['duplicate_of']))
+                    copied.append(output_filename)
+                    manifest[output_filename] = job_hash
+                elif err is None:
+                    print ("Creating %s ... done" % output_filename)
+                    rendered.append(output_filename)
+                    if job_hash is not None:
+                        manifest[output_filename] = job_hash
+                else:
+                    print ("Creating %s ... ERROR: %s" % (output_filename, err))
+                    manifest.pop(output_filename, None)
+                    failed[output_filename] = err
+        finally:
+            # Even if the batch is stopped partway, keep what was done so
+            # far for the next run to skip
+            if timings_file:
+                timings_file.close()
+            self._save_manifest(manifest)
+            summary = {'shards': [{'shard': self.shard, 'seconds': timing.timer() - start_time}],
+                       'rendered': rendered, 'copied': copied, 'skipped': skipped, 'failed': failed}
+            if self.summary_filename:
+                save_summary(summary, self.summary_filename)
+        if self.manifest_filename is not None:
+            print_summary(summary)
+        if failed:
+            error("%d of %d conversions failed" % (len(failed), len(rendered) + len(copied) + len(failed)))
+
+    def _render_all(self, pending):
+        """
+            Render each (job, job_hash) from pending, yielding it back with
+            the result of render_job, in order.  A job that duplicates an
+            earlier one isn't rendered, and comes back with None.
+
+            With self.jobs > 1 the jobs go to a pool of processes, but only a
+            couple per process are queued at a time, so pending (and the config
+            behind it) is read no faster than the jobs are rendered.
+        """
+        if self.jobs == 1:
+            for job, job_hash in pending:
+                yield job, job_hash, None if 'duplicate_of' in job else render_job(job)
+            return
+
+        pool = None
+        queued = collections.deque()
+        try:
+            for job, job_hash in pending:
+                if 'duplicate_of' in job:
+                    result = None
+                else:
+                    if pool is None:
+                        # Import the plugin once here rather than in every worker
+                        try:
+                            get_plugin(job['format'], job['template'])
+                        except Exception:
+                            pass  # Reported by the job itself
+                        pool = multiprocessing.Pool(self.jobs, init_worker,
+                                                    (resume_cache.cache_dir,))
+                    result = pool.apply_async(render_job, (job,))
+                queued.append((job, job_hash, result))
+                while len(queued) >= 2 * self.jobs:
+                    job, job_hash, result = queued.popleft()
+                    yield job, job_hash, result and result.get()
+            while queued:
+                job, job_hash, result = queued.popleft()
+                yield job, job_hash, result and result.get()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
-        for i, c in enumerate(self.config):
-            # For each conversion
-            if not 'data' in c:
-                # Check that the yaml resume file is specified
-                error("Configuration file has not defined 'data' with resume yaml file")
+    def merge_summaries(self):
+        """
+            Combine the summaries of the shards of a batch, checking that
+            every shard is there exactly once
+        """
+        merged = {'shards': [], 'rendered': [], 'copied': [], 'skipped': [], 'failed': {}}
+        for summary_filename in self.summaries:
+            with open(summary_filename) as f:
+                summary = json.load(f)
+            merged['shards'] += summary['shards']
+            merged['rendered'] += summary['rendered']
+            merged['copied'] += summary.get('copied', [])
+            merged['skipped'] += summary['skipped']
+            merged['failed'].update(summary['failed'])
+
+        shards = [tuple(s['shard']) for s in merged['shards'] if s['shard'] is not None]
+        counts = set(count for _, count in shards)
+        if len(counts) > 1:
+            error("Summaries are from different shard counts: %s" % ' '.join(str(c) for c in sorted(counts)))
+        if counts:
+            count = counts.pop()
+            missing = sorted(set(range(count)) - set(index for index, _ in shards))
+            if missing:
+                logging.warning("Missing summaries for shards %s of %d" % (' '.join(str(i) for i in missing), count))
+            if len(shards) != len(set(shards)):
+                logging.warning("Some shards have more than one summary")
+
+        if self.merged_filename:
+            save_summary(merged, self.merged_filename)
+        print_summary(merged)
+        if merged['failed']:
+            error("%d conversions failed" % len(merged['failed']))
+
+
+    def render_to(self, output, template_file, resume, fmt, skip=False, options=None):
+        """
+            Render the resume dict with template_file in format fmt (e.g. 'Word')
+            into output, which can be a filename or any writable binary file
+            object such as an HTTP response or an upload stream.
+        """
+        plugin = get_plugin(fmt, template_file)
+        plugin(template_file, resume, skip, options).render(output)
+
+    def render_bytes(self, template_file, resume, fmt, skip=False, options=None):
+        """
+            Render the resume dict like render_to, but return the document as bytes
+        """
+        plugin = get_plugin(fmt, template_file)
+        return plugin(template_file, resume, skip, options).render_bytes()
+
+    def watch(self):
+        """
+            Run the single conversion in self.config, then again each time
+            its resume or template file changes, until interrupted.  The plugin
+            keeps what it can from one render to the next (see render_cache).
+        """
+        job = next(self.get_jobs())
+        render_cache = {}
+        last_stats = None
+        print("Watching %s and %s, press Ctrl-C to stop" % (job['data'], job['template']))
+        try:
+            while True:
+                try:
+                    stats = [(st.st_mtime, st.st_size) for st in
+                                (os.stat(job['data']), os.stat(job['template']))]
+                except OSError:
+                    # Editors can remove a file for a moment while saving it
+                    stats = last_stats
+                if stats != last_stats:
+                    last_stats = stats
+                    self._render_watched(job, render_cache)
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+
+    def _render_watched(self, job, render_cache):
+        start_time = timing.timer()
+        try:
+            plugin = get_plugin(job['format'], job['template'])
+            text = plugin(job['template'], load_resume(job['data']), job['skip'], job['options'])
+            text.render_cache = render_cache
+            text.render(job['output'])
+        except Exception as e:
+            # Most likely a half-finished edit, so carry on watching
+            logging.debug(traceback.format_exc())
+            print("Creating %s ... ERROR: %s" % (job['output'], str(e) or e.__class__.__name__))
+            render_cache.clear()
+        else:
+            print("Creating %s ... done in %d ms" % (job['output'],
+                                                     (timing.timer() - start_time) * 1000))
+
+    def serve(self):
+        """
+            Stay running with the plugins and templates loaded, rendering
+            each request as it comes in (see handle_request)
+        """
+        for template_file in self.preload:
+            ext = os.path.splitext(template_file)[1][1:]
+            for p, info in Plugin.available.items():
+                if info.template_file_extension == ext:
+                    Plugin.get(p).load_template(template_file)
+                    break
             else:
-                with open(c['data']) as resume_file:
-                    self.resume = yaml.load(resume_file)
-
-            for output in c['outputs']:
-                fmt = output['format']
-                # Check that we have a plugin whose classname starts with this format
-                assert any([x.startswith(fmt) for x in Plugin.registered])
-                template_file = output['template']
-                filebasename,filetype = os.path.splitext(template_file)
-                if filetype[1:] not in self.allowed_filetypes:
-                    error("File type/extension %s is not one of following: %s" % (filetype,' '.join(self.allowed_filetypes)))
-                output_filename = output['output']
-                # Instantiate the required conversion plugin
-                print ("Creating %s ..." % output_filename, end='')
-                text = Plugin.registered['%sResume' % fmt](template_file, self.resume, self.skip)
-                text.render(output_filename)
-                print (" done")
+                error("No plugin for template %s" % template_file)
 
+        if self.socket_path is None:
+            def write(text):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            serve_lines(iter(sys.stdin.readline, ''), write)
+            return
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = RenderServer(self.socket_path, RequestHandler)
+        print("Listening on %s" % self.socket_path, file=sys.stderr)
+        # Clean up the socket on kill too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
 
     def go(self, argv):
         # Read the command line options
         self.getOptions(argv)
-        self.run_rendering()
+        if self.subparser_name == 'merge':
+            self.merge_summaries()
+        elif self.subparser_name == 'watch':
+            self.watch()
+        elif self.subparser_name == 'serve':
+            self.serve()
+        else:
+            self.run_rendering()
 
 if __name__ == '__main__':
     script = OneResume()
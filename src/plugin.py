@@ -22,12 +22,31 @@
 """
 
 import logging
+import io
+import os
+import sys
+import ast
+import threading
+from collections import namedtuple, OrderedDict
 
 import imp
 import pkgutil
 
 
+# What Plugin.load finds out about a plugin class without importing its module
+PluginInfo = namedtuple('PluginInfo', 'name module_name pathname template_file_extension version')
+
+
 class Plugin(object):
+
+    # Directory plugins can keep compiled templates etc. in between runs
+    cache_dir = None
+    # A dict that a caller rendering the same output again and again (see
+    # the watch command) can set, for the plugin to keep work in between
+    render_cache = None
+    # Name -> PluginInfo of every plugin found by load(), imported or not
+    available = OrderedDict()
+    _import_lock = threading.Lock()
      
     class __metaclass__(type):
              
@@ -38,17 +57,94 @@ class Plugin(object):
                 #cls.registered.append(cls)
                 cls.registered[name] = cls
                                      
+    def render_bytes(self):
+        """
+            Return the rendered document as bytes instead of writing it out.
+            Plugins' render() takes either a filename or a binary file object.
+        """
+        output = io.BytesIO()
+        self.render(output)
+        return output.getvalue()
+
+    @classmethod
+    def load_template(cls, template_file):
+        """
+            Parse template_file ahead of time, so that later renders with it
+            start warm.  Plugins that cache their templates override this.
+        """
+        pass
+
     @classmethod
     def load(cls, *paths):
+        """
+            Find the plugins in the modules on paths.  The modules are only
+            parsed here, not imported, so the libraries a plugin needs are
+            not loaded until get() is first asked for it.
+        """
         paths = list(paths)
         cls.registered = {}
+        cls.available = OrderedDict()
         for _, name, _ in pkgutil.iter_modules(paths):
             fid, pathname, desc = imp.find_module(name, paths)
-            try:
-                imp.load_module(name, fid, pathname, desc)
-            except Exception as e:
-                logging.warning("could not load plugin module '%s': %s",
-                                pathname, e.message)
             if fid:
                 fid.close()
+            if desc[2] != imp.PY_SOURCE:
+                continue
+            try:
+                for info in cls._scan_module(name, pathname):
+                    cls.available[info.name] = info
+            except (SyntaxError, IOError) as e:
+                logging.warning("could not read plugin module '%s': %s", pathname, e)
+
+    @classmethod
+    def get(cls, name):
+        """
+            Return the plugin class called name, importing its module the
+            first time.  An error importing it is raised to the caller
+            rather than making the plugin quietly disappear.
+        """
+        if name in cls.registered:
+            return cls.registered[name]
+        # Threads of the render server mustn't import the same module twice
+        with cls._import_lock:
+            if name in cls.registered:
+                return cls.registered[name]
+            info = cls.available[name]
+            module = sys.modules.get(info.module_name)
+            if module is None:
+                try:
+                    module = imp.load_source(info.module_name, info.pathname)
+                except Exception as e:
+                    raise ImportError("could not load plugin module '%s': %s" % (info.pathname, e))
+            cls.registered[name] = getattr(module, name)
+            return cls.registered[name]
 
+    @staticmethod
+    def _scan_module(module_name, pathname):
+        """
+            Yield a PluginInfo for each class in the module source that
+            subclasses Plugin, reading its metadata from literal class
+            attributes
+        """
+        with open(pathname) as f:
+            tree = ast.parse(f.read(), pathname)
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            base_names = [getattr(base, 'id', getattr(base, 'attr', None)) for base in node.bases]
+            if 'Plugin' not in base_names:
+                continue
+            attrs = {}
+            for stmt in node.body:
+                if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                        and isinstance(stmt.targets[0], ast.Name)):
+                    try:
+                        attrs[stmt.targets[0].id] = ast.literal_eval(stmt.value)
+                    except ValueError:
+                        pass
+            if 'template_file_extension' not in attrs:
+                logging.warning("plugin %s in '%s' has no template_file_extension",
+                                node.name, pathname)
+                continue
+            yield PluginInfo(node.name, module_name, os.path.abspath(pathname),
+                             attrs['template_file_extension'], attrs.get('version', 0))
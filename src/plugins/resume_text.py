@@ -14,38 +14,101 @@
 # limitations under the License.
 
 import logging
-from mako.template import Template
+import os
+import hashlib
+from mako.lookup import TemplateLookup
 from textwrap import TextWrapper
 from plugin import Plugin
+import timing
+
+# One TemplateLookup per (template directory, module directory).  Each lookup
+# keeps its compiled templates in memory and only recompiles one when its file
+# changes; with a module directory the compiled modules are also kept on disk.
+_lookups = {}
+
+def get_template(template_filename, cache_dir=None):
+    template_dir, template_name = os.path.split(os.path.realpath(template_filename))
+    if cache_dir:
+        # Keep templates with the same name in different directories apart
+        dir_hash = hashlib.sha1(template_dir.encode('utf-8')).hexdigest()[:16]
+        module_directory = os.path.join(cache_dir, 'mako', dir_hash)
+    else:
+        module_directory = None
+    key = (template_dir, module_directory)
+    if key not in _lookups:
+        _lookups[key] = TemplateLookup(directories=[template_dir],
+                                       module_directory=module_directory,
+                                       filesystem_checks=True)
+    return _lookups[key].get_template(template_name)
+
+# TextWrappers by (indent, width), and the wrapped text for strings seen
+# before.  The templates wrap the same skill lists and summaries for every
+# resume in a batch.
+_wrappers = {}
+_wrapped = {}
+_max_wrapped = 4096
+
+def wrap(indent, s, width):
+    key = (indent, width, s)
+    # One lookup, as another thread can clear _wrapped in between two
+    txt = _wrapped.get(key)
+    if txt is not None:
+        return txt
+    if (indent, width) not in _wrappers:
+        indent_str = "  " * indent
+        _wrappers[(indent, width)] = TextWrapper( width=width, subsequent_indent = indent_str)
+    txt = '\n'.join(_wrappers[(indent, width)].wrap(s))
+    if len(_wrapped) >= _max_wrapped:
+        _wrapped.clear()
+    _wrapped[key] = txt
+    return txt
 
 class TextResume(Plugin):
 
     template_file_extension = 'mako'
+    version = 1
 
-    def __init__ (self, template_file, resume_data, skip):
+    def __init__ (self, template_file, resume_data, skip, options=None):
+        options = options or {}
         self.skip = skip
         self.resume_data = resume_data
         self.template_filename = template_file
         self.indent_spaces = 2
+        # Default width for _wrap, can be set per output in the config
+        self.width = int(options.get('width', 70))
+
+    @classmethod
+    def load_template(cls, template_file):
+        return get_template(template_file, cls.cache_dir)
 
-    def render(self, output_filename):
-        with open(output_filename, "w") as output_file:
-            txt = self._get_rendered_text()
-            output_file.write(txt)
+    def render(self, output):
+        """
+            Write the text to output, a filename or a binary file object
+        """
+        txt = self.render_bytes()
+        if hasattr(output, 'write'):
+            output.write(txt)
+        else:
+            with open(output, "wb") as output_file:
+                output_file.write(txt)
+
+    def render_bytes(self):
+        txt = self._get_rendered_text()
+        if not isinstance(txt, bytes):
+            txt = txt.encode('utf-8')
+        return txt
 
     def _get_rendered_text(self):
-        with open(self.template_filename) as tmpl_file:
-            tmpl_text = tmpl_file.read()
-        tmpl = Template(tmpl_text)
-        txt =  tmpl.render(d=self.resume_data, s=self)
+        with timing.stage('mako_compile'):
+            tmpl = self.load_template(self.template_filename)
+        with timing.stage('mako_render'):
+            txt =  tmpl.render(d=self.resume_data, s=self)
         logging.debug(txt)
         return txt
         
 
-    def _wrap(self, indent, s, width=70):
-        indent_str = "  " * indent
-        t = TextWrapper( width=width, subsequent_indent = indent_str)
-        return '\n'.join(t.wrap(s))
+    def _wrap(self, indent, s, width=None):
+        return wrap(indent, s, width or self.width)
             
 
 
@@ -41,20 +41,69 @@
 
 
 import zipfile, re
-import os,shutil
-from plugin import Plugin
+import os
+import struct
+import zlib
 from lxml import etree
 import logging
-import itertools
 import copy
-from collections import OrderedDict
-import tempfile
 
 from plugin import Plugin
+import timing
+
+
+class TemplateError(Exception):
+    pass
+
+
+class LoopSection(object):
+    """
+        One [tag] heading in the template and the <...> loop that follows it
+    """
+    def __init__(self, tags, heading, paragraphs):
+        self.tags = tags        # Raw tag texts found in the heading text node
+        self.heading = heading  # The heading's w:t node
+        self.paragraphs = paragraphs  # The loop's paragraphs, until they get cut out
+        self.loop = None        # The compiled Loop
+        self.source = None      # Copy of the loop as written, for resumes without this section
+        self.heading_path = None
+        self.parent_path = None
+        self.index = None
+
+
+class Loop(object):
+    """
+        A <...> loop, compiled so that it can be instanced once per list element
+    """
+    def __init__(self, body):
+        self.body = body        # 'root' element holding the loop's own paragraphs
+        self.slots = []         # (path in body, tokens) of each w:t node to fill in
+        self.loops = []         # NestedLoops inside this one
+
+
+class NestedLoop(object):
+    """
+        A loop inside another loop, over the list named by the [tag] before it
+    """
+    def __init__(self, tag, loop, index, heading_index):
+        self.tag = tag          # Raw tag text, e.g. 'projects', '!projects' or 'projects|Projects:'
+        self.key = tag.lstrip('!').split('|')[0]
+        self.hidden = tag.startswith('!')
+        self.heading_text = '' if self.hidden else tag.split('|')[-1]
+        self.loop = loop
+        self.index = index      # Where its instances go among the enclosing body's paragraphs
+        self.heading_index = heading_index  # The tag's paragraph in the enclosing body
+
+
+class CompiledWordTemplate(object):
+    """
+        A Word template that has been read and parsed once.
+
+        The zip is read, split bracket tags are joined and every section heading
+        and loop body is located up front.  The loop bodies are cut out of the
+        document, leaving a skeleton that render() clones for each resume.
+    """
 
-class WordResume(Plugin):
-
-    template_file_extension = 'docx'
     nsprefixes = {
     'mo': 'http://schemas.microsoft.com/office/mac/office/2008/main',
     'o':  'urn:schemas-microsoft-com:office:office',
@@ -84,32 +133,216 @@ class WordResume(Plugin):
     'dcmitype': 'http://purl.org/dc/dcmitype/',
     'dcterms':  'http://purl.org/dc/terms/'}
 
-    def __init__ (self, template_file, resume_data, skip):
-        self.skip = skip
-        self.resume_data = resume_data
-        self.template_filename = template_file
-        self.template = open (self.template_filename)
-
-        self.zipfile = zipfile.ZipFile(self.template)
-        self.doc_etree = self._get_doc_from_docx()
-
-        #self._test_func()
-        #self._write_and_close_docx(self.doc_etree)
+    # Clark notation names of the w: elements we look at, worked out once
+    # here so tag checks and tag-filtered iteration never build strings
+    _w = nsprefixes['w']
+    wtag = {'document': '{%s}document' % _w,
+            'body':     '{%s}body' % _w,
+            'p':        '{%s}p' % _w,
+            'r':        '{%s}r' % _w,
+            't':        '{%s}t' % _w,
+            'tbl':      '{%s}tbl' % _w,
+            'tr':       '{%s}tr' % _w,
+            'tc':       '{%s}tc' % _w,
+           }
+    del _w
+
+    # Real path of the .docx -> ((mtime, size), its compiled template)
+    _compiled = {}
+
+    mBracket = re.compile(r"""[\[\]]""")
+
+    # Any [subtag] inside a loop body
+    mSubtag = re.compile(r"""\[([^\[\]]*)\]""")
+    mMarker = re.compile(r"""[<>]""")
+    mLoopToken = re.compile(r"""[<>]|\[([^\[\]]*)\]""")
+    mLoopMarker = re.compile(br"""<!--oneresume-loop-(\d+)-->""")
+
+    @classmethod
+    def load(cls, template_filename):
+        """
+            Return the compiled template for this file, only parsing it if
+            it's new or has changed on disk
+        """
+        st = os.stat(template_filename)
+        path = os.path.realpath(template_filename)
+        stamp = (st.st_mtime, st.st_size)
+        compiled = cls._compiled.get(path)
+        if compiled is None or compiled[0] != stamp:
+            # Replaces any older compile of the file, so saves don't pile up
+            logging.debug("Compiling Word template %s" % template_filename)
+            compiled = (stamp, cls(template_filename))
+            cls._compiled[path] = compiled
+        return compiled[1]
+
+    def __init__ (self, template_filename):
+        self.template_filename = template_filename
+
+        with timing.stage('template_read'), zipfile.ZipFile(self.template_filename) as template_zip:
+            xml_content = template_zip.read('word/document.xml')
+            # Keep every member's compressed bytes so writing an output never
+            # has to go back to the template file
+            self.members = [(info, self._read_raw_member(template_zip, info))
+                                for info in template_zip.infolist()]
+
+        self.skeleton = etree.fromstring(xml_content)
+        body = self.skeleton.find(self.wtag['body'])
+        with timing.stage('join_tags'):
+            self._join_tags(body)
+        with timing.stage('tag_discovery'):
+            self.sections = self._find_sections(self.skeleton)
+        with timing.stage('loop_extraction'):
+            self._cut_loops(self.skeleton, self.sections)
+
+    def render(self, resume_data, skip=False, cache=None):
+        """
+            Return a new document tree with resume_data substituted in.
+            With skip set, the template is returned with only its tags joined.
 
-    def render(self, output_filename):
-        self._parse_xml()
-        self._write_and_close_docx(self.doc_etree, output_filename)
+            cache is an optional dict kept by the caller between renders of
+            the same output.  Sections whose entries haven't changed since the
+            last render reuse its expanded loops, which are moved out of the
+            last document into the new one, so only the newest is complete.
+        """
+        if cache is not None and cache.get('template') is not self:
+            cache.clear()
+            cache['template'] = self
+        def expand(section_index, section, key, entries):
+            return self._expand_section(section_index, section, key, entries, cache)
+        return self._render_skeleton(resume_data, skip, expand)
+
+    def write_docx_streaming(self, resume_data, output, skip=False,
+                             compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        """
+            Write the same docx as write_docx(render(resume_data, skip), output)
+            without ever holding the whole document.  The loops are instanced
+            one entry at a time and written straight into the zip, so memory
+            use depends on the template and the biggest entry rather than
+            on the length of the resume.  The xml is never pretty-printed.
+        """
+        loops = []
+        def expand(section_index, section, key, entries):
+            if self._node_at(self.skeleton, section.parent_path).tag == self.wtag['tc']:
+                # Inside a table cell the loop has to be there to decide whether
+                # a hidden heading can go (see _remove_paragraph), and is small
+                return self._instance_loop(section.loop, entries, key)
+            # Marks where the loop goes when the rest is serialized
+            loops.append((section.loop, entries, key))
+            return [etree.Comment('oneresume-loop-%d' % (len(loops) - 1))]
+
+        with timing.stage('loop_expansion'):
+            doc = self._render_skeleton(resume_data, skip, expand)
+        self._write_zip(output, lambda f: self._write_streaming(f, doc, loops),
+                        compression_level)
+
+    def _write_streaming(self, f, doc, loops):
+        """
+            Write doc to f with the loops instanced in place of their markers
+        """
+        # Serializing an element on its own declares all of its namespaces on
+        # it, so drop those the document element already declares.  (This is
+        # also why etree.xmlfile isn't used: its write() does the same.)
+        declarations = [(' xmlns:%s="%s"' % (prefix, uri) if prefix else ' xmlns="%s"' % uri).encode('utf-8')
+                            for prefix, uri in doc.nsmap.items()]
+        parts = self.mLoopMarker.split(etree.tostring(doc))
+        f.write(parts[0])
+        for i in range(1, len(parts), 2):
+            loop, entries, key = loops[int(parts[i])]
+            subtag_keys = self._get_all_keys_in_list_of_dicts(entries, key)
+            for subtag_dict in entries:
+                for element in self._instance_entry(loop, subtag_dict, subtag_keys):
+                    xml = etree.tostring(element)
+                    start_tag_end = xml.index(b'>')
+                    start_tag = xml[:start_tag_end]
+                    for declaration in declarations:
+                        start_tag = start_tag.replace(declaration, b'', 1)
+                    f.write(start_tag + xml[start_tag_end:])
+            f.write(parts[i + 1])
+
+    def _render_skeleton(self, resume_data, skip, expand):
+        """
+            Return a copy of the skeleton with its headings filled in from
+            resume_data, and expand(section_index, section, key, entries)
+            inserted wherever a section's loop goes
+        """
+        doc = copy.deepcopy(self.skeleton)
+
+        # Look up every slot in the copy before changing it, so the paths stay valid
+        slots = [(section, self._node_at(doc, section.heading_path),
+                           self._node_at(doc, section.parent_path))
+                    for section in self.sections]
+
+        hidden_paragraphs = []
+        # Go backwards so that inserting a loop never shifts the index of one still to come
+        for section_index, (section, heading, parent) in reversed(list(enumerate(slots))):
+            key, tag = (None, None) if skip else self._get_section_key(section, resume_data)
+            if key is not None:
+                logging.debug("Subtag search for %s" % key)
+                if '[!' in heading.text:
+                    hidden_paragraphs.append(self._get_parent_paragraph(heading))
+                else:
+                    heading.text = heading.text.replace('['+tag+']', tag)
+                    if '|' in heading.text:
+                        # We have alternate text so just use that
+                        heading.text = heading.text.split('|')[1]
+
+            if section.loop is None:
+                continue
+            if key is None:
+                # Not in the resume, so put the loop back in as it was
+                elements = copy.deepcopy(section.source).getchildren()
+            else:
+                elements = expand(section_index, section, key, resume_data[key])
+            for i, element in enumerate(elements):
+                parent.insert(section.index + i, element)
+
+        for paragraph in hidden_paragraphs:
+            self._remove_paragraph(paragraph)
+        return doc
+
+    def _expand_section(self, section_index, section, key, entries, cache):
+        """
+            Instance the section's loop over entries, or take the elements
+            from the last render in cache if they were made from the same ones
+        """
+        if cache is None:
+            return self._instance_loop(section.loop, entries, key)
+        # Compared as rendered rather than with ==, which has 1 == True == 1.0
+        rendered = self._get_rendered_values(entries)
+        cached = cache.get(section_index)
+        if cached is not None and cached[0] == key and cached[1] == rendered:
+            return cached[2]
+        elements = self._instance_loop(section.loop, entries, key)
+        cache[section_index] = (key, rendered, elements)
+        return elements
+
+    def _get_rendered_values(self, value):
+        """
+            Return what instancing a loop over value depends on: the str()
+            of every value filled in, and the lists nested loops go over
+        """
+        if isinstance(value, dict):
+            return dict((k, (str(v), self._get_rendered_values(v))) for k, v in value.items())
+        if isinstance(value, list):
+            return [self._get_rendered_values(v) for v in value]
+        return None
 
     def _check_element_is(self, element, type_char):
-        return element.tag == '{%s}%s' % (self.nsprefixes['w'],type_char)
+        return element.tag == self.wtag[type_char]
     def _assert_element_is(self, element, type_char):
         assert self._check_element_is(element, type_char)
 
     def _get_all_text_in_node(self, node):
-        all_txt = []
-        for txt in node.itertext(tag=etree.Element):
-            all_txt.append(txt)
-        return ''.join(all_txt)
+        return ''.join(node.itertext(self.wtag['t'], with_tail=False))
+
+    def _remove_paragraph(self, paragraph):
+        parent = paragraph.getparent()
+        if parent.tag == self.wtag['tc'] and len(parent.findall(self.wtag['p'])) == 1:
+            # A table cell has to keep a paragraph, so just empty it
+            for node in paragraph.iter(self.wtag['t']):
+                node.text = ''
+        else:
+            parent.remove(paragraph)
 
     def _get_parent_paragraph(self, text_node):
         self._assert_element_is(text_node, 't')
@@ -119,272 +352,500 @@ class WordResume(Plugin):
         self._assert_element_is(paragraph, 'p')
         return paragraph
 
-    def _find_subtags_in_loop(self, my_etree, subtag_list):
+    def _find_sections(self, my_etree):
         """
+            Find every [tag] heading and the loop that follows it.
+
             Assumptions:
                 - All loop starts are in their own paragraphs
                 - loops can span multiple paragraphs
                 - Any content after the loop must be in different paragraph
-                - No tables anywhere!
-        """
-        mTag = r"""\[(?P<tag>[\s\w\_]+)\]"""
-        tags = OrderedDict()
-
-        # Get the parent paragraph 
-        paragraph = self._get_parent_paragraph(my_etree)
-
-        # Variables to track the state of our traversals
-        loop_done = False
-        loop_tree_index = 0
-        inside_loop = False
-
-        # Keep track of all the elements belonging to the loop body
-        # so that we can delete the original loop definition once
-        # we are done instancing the loop.
-        elements_to_delete = []
-        # build up a copy of the loop sub-tree in loop_tree
-        # We will instance this as many times as needed
-        loop_tree = etree.Element("root")  # Keep a copy of the loop that we find
-        for node, text, node_index in self._itersiblingtext(paragraph):
-            if '<' in text:
-                logging.debug("Found <")
-                if inside_loop:  # embedded loop!
-                    # Let's recurse on this embedded loop
-                    #  We need the immediately preceding tag text to figure
-                    # out what dict we need to recurse on
-                    self._find_subtags_in_loop
-                else:
-                    inside_loop = True
-                    loop_tree_start = (node.getparent().getparent())
-                    self._assert_element_is(loop_tree_start, 'p')
-
-                    elements_to_delete.append(loop_tree_start)
-                    loop_tree.insert(0, copy.deepcopy(loop_tree_start))
-
-                    logging.debug(etree.tostring(loop_tree, pretty_print=True))
-            if '>' in text:
-                assert inside_loop
-                logging.debug("Found >")
-                loop_done = True
-                if node_index != loop_tree_index:
-                    self._assert_element_is(node.getparent().getparent(), 'p')
-                    loop_tree.insert(loop_tree_index+1,  copy.deepcopy(node.getparent().getparent()))
-                    loop_tree_index += 1
-                    elements_to_delete.append(node.getparent().getparent())
-                    assert (node_index == loop_tree_index)
-                break
-            if inside_loop:
-                # Have to check if we've moved to a different paragraph
-                # If so, we need to add it to the tree
-                logging.debug("Here")
-                if node_index != loop_tree_index:
-                    logging.debug("Adding inside loop text node")
-                    self._assert_element_is(node.getparent().getparent(), 'p')
-
-                    loop_tree.insert(loop_tree_index+1,  copy.deepcopy(node.getparent().getparent()))
-                    loop_tree_index += 1
-
-                    logging.debug(etree.tostring(loop_tree, pretty_print=True))
-                    elements_to_delete.append(node.getparent().getparent())
-                    assert (node_index == loop_tree_index)
-                    
-        logging.debug("Found a loop spanning %d paragraphs, %d" % (loop_tree_index+1, len(loop_tree)))
-
-        # Max possible set of subtags
-        subtag_keys = self._get_all_keys_in_list_of_dicts(subtag_list)
-
-        loop_instance = []
-        for subtag_dict in subtag_list:
-            loop_done = False
-            # Create a copy of the loop_tree
-            #loop_instance.append([])
-            loop_instance.append(copy.deepcopy(loop_tree))
-            logging.debug("Applying loop element: %s" % subtag_dict)
-
-            for node, text, node_i in self._itersiblingtext(loop_instance[-1]):
-                logging.debug("Going through text")
-                if '<' in text:
-                    node.text = node.text.replace('<','')
-                if '>' in text:
-                    node.text = node.text.replace('>','')
-                tag_text = re.findall(mTag, text)
-                logging.debug("tag text is %s" % tag_text)
-                if node.text:
-                    for key in subtag_keys:
-                        logging.debug("Looking for key %s" % key)
-                        if key in subtag_dict:
-                            node.text = node.text.replace('['+key+']', str(subtag_dict[key]))
-                        else:
-                            node.text = node.text.replace('['+key+']', '')
-                for tag in tag_text:
-                    tag = tag.lower()
-                    tags[tag] = node
-
-        # Now, add the loop_instance to the body
-        body = loop_tree_start.getparent()
-        index_to_insert_at = body.index(loop_tree_start)+1
-        logging.debug("Inserting at index %d" % index_to_insert_at)
-        for inst in loop_instance:
-            for child in inst.getchildren():
-                body.insert(index_to_insert_at, child)
-                index_to_insert_at += 1
-
-        # Delete the loop template
-        for e in elements_to_delete:
-            body.remove(e)
-
-
-        if '[!' in my_etree.text:
-            paragraph.getparent().remove(paragraph)
-        return tags
-
-    def _find_tags(self, my_etree, tags_to_find, char_to_stop_on=None):
-        """
-            Build a dict of all the tags in the document and the corresponding
-            text node
-            
-        """
-
-        tags = {}
-        logging.debug("Looking for tags: %s" % (','.join(tags_to_find)))
+                - Loops can be nested.  The last [tag] in the enclosing loop
+                  before a nested loop's '<' names the list it goes over, and
+                  must be in an earlier paragraph.  The nested loop has to end
+                  before the paragraph that ends the enclosing loop.
+                - A loop in a table repeats whole rows, and has to start and
+                  end in the same table.  Everything above about paragraphs
+                  goes for rows there.
+        """
         mTag = r"""\[\!?(?P<tag>[\s\w\_\|]+)\]"""
-        for node,text in self._itertext(my_etree):
-            tag_text = re.findall(mTag, text) 
+        headings = []
+        for node, text in self._itertext(my_etree):
+            if not text:
+                continue
+            tag_text = re.findall(mTag, text)
             if tag_text:
                 logging.debug("Found grps %s" % (','.join(tag_text)))
-            for tag in tag_text:
-                tag_lower = tag.lower()
-                tag_lower = tag_lower.split('|')[0]
-                if tag_lower in tags_to_find:
-                    tags[tag_lower] = node
-                    # Replace the brackets with nothing
-                    if '[!' in node.text:
-                        #node.text = node.text.replace('[!'+tag+']', 'lsdjflkd')
-                        body = node.getparent().getparent().getparent()
-                        #body.remove(node.getparent().getparent())
+                headings.append((node, tag_text))
+        tag_paragraphs = set(self._get_parent_paragraph(node) for node, _ in headings)
+
+        sections = []
+        loop_units = set()
+        for node, tag_text in headings:
+            paragraph = self._get_parent_paragraph(node)
+            if paragraph in loop_units or any(row in loop_units
+                            for row in paragraph.iterancestors(self.wtag['tr'])):
+                # These are the loop's own [subtags]
+                continue
+            loop = self._find_loop(paragraph, tag_paragraphs)
+            loop_units.update(loop)
+            logging.debug("Found a loop spanning %d paragraphs/rows" % len(loop))
+            sections.append(LoopSection(tag_text, node, loop))
+        return sections
+
+    def _iter_units_after(self, paragraph):
+        """
+            Go through the paragraphs and table rows after paragraph: its
+            siblings, with any tables opened up into their rows, and if it's
+            in a table cell, the rows after the cell's row
+        """
+        for sib in paragraph.itersiblings(tag=etree.Element):
+            if sib.tag == self.wtag['tbl']:
+                for row in sib.iterchildren(self.wtag['tr']):
+                    yield row
+            else:
+                yield sib
+        parent = paragraph.getparent()
+        if parent.tag == self.wtag['tc']:
+            for row in parent.getparent().itersiblings(self.wtag['tr']):
+                yield row
+
+    def _find_loop(self, paragraph, tag_paragraphs):
+        """
+            Return the list of paragraphs (or table rows) from the one containing
+            '<' to the one containing its matching '>', looking at what follows
+            paragraph
+        """
+        loop = []
+        depth = 0
+        for unit in self._iter_units_after(paragraph):
+            text = self._get_all_text_in_node(unit)
+            if not loop:
+                if '<' in text:
+                    # Ignore any '>' before the loop starts
+                    text = text[text.index('<'):]
+                    if unit.tag not in (self.wtag['p'], self.wtag['tr']):
+                        raise TemplateError("Loop in %s has to be made of whole paragraphs "
+                                            "or table rows" % self.template_filename)
+                    loop_parent = unit.getparent()
+                elif unit in tag_paragraphs or any(p in tag_paragraphs
+                                                for p in unit.iter(self.wtag['p'])):
+                    # Ran into another heading first, so this one has no loop
+                    return []
+                else:
+                    continue
+            elif unit.getparent() is not loop_parent or unit.tag != loop[0].tag:
+                raise TemplateError("Loop in %s has to start and end in the same table, "
+                                    "or outside of tables" % self.template_filename)
+            loop.append(unit)
+            for marker in self.mMarker.findall(text):
+                depth += 1 if marker == '<' else -1
+                if depth == 0:
+                    return loop
+        if loop:
+            logging.warning("Loop in %s is never closed with '>'" % self.template_filename)
+        return loop
+
+    def _cut_loops(self, my_etree, sections):
+        """
+            Move each loop's paragraphs out of the document into its compiled
+            Loop, and record where the expanded loop gets inserted at render time
+        """
+        for section in sections:
+            if section.paragraphs:
+                parent = section.paragraphs[0].getparent()
+                section.index = parent.index(section.paragraphs[0])
+                section.source = etree.Element("root")
+                section.source.extend([copy.deepcopy(p) for p in section.paragraphs])
+                section.loop = self._compile_loop(section.paragraphs)
+                section.parent_path = self._path_of(parent)
+            section.paragraphs = None
+        # Only take the heading paths once all loops are out
+        for section in sections:
+            section.heading_path = self._path_of(section.heading)
+
+    def _compile_loop(self, paragraphs):
+        """
+            Build the Loop for paragraphs, which run from a loop's '<' to its
+            matching '>'.  The markers of any nested loops are matched up in
+            the same pass over the text, giving a tree of paragraph ranges
+            that _build_loop turns into Loops.
+        """
+        top = None
+        open_frames = []
+        for i, paragraph in enumerate(paragraphs):
+            for m in self.mLoopToken.finditer(self._get_all_text_in_node(paragraph)):
+                token = m.group()
+                if token == '<':
+                    frame = {'start': i, 'end': None, 'tag': None,
+                             'nested': [], 'last_tag': None}
+                    if open_frames:
+                        enclosing = open_frames[-1]
+                        if enclosing['last_tag'] is None or enclosing['last_tag'][0] == i:
+                            raise TemplateError("Nested loop in %s needs a [tag] naming its list "
+                                                "in a paragraph before it" % self.template_filename)
+                        frame['tag'] = enclosing['last_tag']
+                        enclosing['last_tag'] = None
+                        enclosing['nested'].append(frame)
+                    elif top is None:
+                        top = frame
                     else:
-                        node.text = node.text.replace('['+tag+']', tag)
-                        if '|' in node.text:
-                            # We have alternate text so just use that
-                            exit
-                            node.text = node.text.split('|')[1]
+                        # Past the end of the loop, so just text
+                        continue
+                    open_frames.append(frame)
+                elif token == '>':
+                    if open_frames:
+                        open_frames.pop()['end'] = i
+                elif open_frames:
+                    open_frames[-1]['last_tag'] = (i, m.group(1))
+        # Unclosed loops (already warned about) run to the end
+        for frame in open_frames:
+            frame['end'] = len(paragraphs) - 1
+        return self._build_loop(paragraphs, top)
+
+    def _build_loop(self, paragraphs, frame):
+        """
+            Move the paragraphs in frame's range into a new Loop, cutting out
+            the ranges of its nested loops and compiling them recursively
+        """
+        body = etree.Element("root")
+        loop = Loop(body)
+        next_i = frame['start']
+        for nested in frame['nested']:
+            tag_i, tag = nested['tag']
+            if tag_i < next_i:
+                raise TemplateError("The [%s] naming a nested loop in %s is inside the loop "
+                                    "before it" % (tag, self.template_filename))
+            if nested['end'] >= frame['end']:
+                raise TemplateError("Nested loop [%s] in %s has to end before the paragraph "
+                                    "that ends its enclosing loop" % (tag, self.template_filename))
+            for paragraph in paragraphs[next_i:nested['start']]:
+                body.append(paragraph)
+            loop.loops.append(NestedLoop(tag, self._build_loop(paragraphs, nested),
+                                         len(body), body.index(paragraphs[tag_i])))
+            next_i = nested['end'] + 1
+        for paragraph in paragraphs[next_i:frame['end'] + 1]:
+            body.append(paragraph)
+        loop.slots = self._find_slots(body)
+        return loop
+
+    def _path_of(self, node):
+        path = []
+        parent = node.getparent()
+        while parent is not None:
+            path.append(parent.index(node))
+            node, parent = parent, parent.getparent()
+        return tuple(reversed(path))
+
+    def _node_at(self, my_etree, path):
+        if path is None:
+            return None
+        node = my_etree
+        for i in path:
+            node = node[i]
+        return node
+
+    def _get_section_key(self, section, resume_data):
+        for tag in section.tags:
+            key = tag.lower().split('|')[0]
+            if key in resume_data:
+                return key, tag
+        return None, None
+
+    def _find_slots(self, loop_tree):
+        """
+            Return (path, tokens) for just the w:t nodes in the loop body that
+            change when it's instanced, so each copy can be patched by index
+            without walking it
+        """
+        slots = []
+        for node, text in self._itertext(loop_tree):
+            tokens = self._tokenize(text)
+            if tokens is not None:
+                slots.append((self._path_of(node), tokens))
+        return slots
+
+    def _tokenize(self, text):
+        """
+            Split a loop body text node into [literal, subtag, literal, ... literal]
+            with the loop markers taken out.  Returns None if the text never changes.
+        """
+        if not text:
+            return None
+        stripped = text.replace('<','').replace('>','')
+        tokens = self.mSubtag.split(stripped)
+        if len(tokens) == 1 and stripped == text:
+            return None
+        return tokens
+
+    def _fill(self, tokens, values):
+        parts = list(tokens)
+        for i in range(1, len(parts), 2):
+            key = parts[i]
+            parts[i] = values[key] if key in values else '[%s]' % key
+        return ''.join(parts)
+
+    def _instance_loop(self, loop, subtag_list, name):
+        """
+            Make one copy of the loop body for every element in subtag_list,
+            the resume's list called name, filling in its [subtags] and
+            instancing any nested loops over the element's own lists.
+            Returns the list of new paragraphs.
+        """
+        # Max possible set of subtags.  Any of these missing from an element
+        # is filled in as blank, anything else in brackets is left alone.
+        subtag_keys = self._get_all_keys_in_list_of_dicts(subtag_list, name)
 
-        return tags
+        elements = []
+        for subtag_dict in subtag_list:
+            elements.extend(self._instance_entry(loop, subtag_dict, subtag_keys))
+        return elements
 
-    def _get_all_keys_in_list_of_dicts(self, mylist):
+    def _instance_entry(self, loop, subtag_dict, subtag_keys):
+        """
+            Return the paragraphs of one copy of the loop body, for the
+            element subtag_dict of a list whose elements have subtag_keys
+        """
+        loop_instance = copy.deepcopy(loop.body)
+        logging.debug("Applying loop element: %s" % subtag_dict)
+
+        values = dict.fromkeys(subtag_keys, '')
+        for key, value in subtag_dict.items():
+            values[key] = str(value)
+
+        nested_lists = []
+        hidden_paragraphs = []
+        for nested in loop.loops:
+            sublist = subtag_dict.get(nested.key)
+            if not isinstance(sublist, list):
+                sublist = []
+            # The tag naming a nested loop works like a section heading,
+            # and is blanked out if this element has nothing to loop over
+            values[nested.tag] = nested.heading_text if sublist else ''
+            if nested.hidden:
+                hidden_paragraphs.append(loop_instance[nested.heading_index])
+            nested_lists.append((nested, sublist))
+
+        for path, tokens in loop.slots:
+            self._node_at(loop_instance, path).text = self._fill(tokens, values)
+
+        # Go backwards so that inserting never shifts the index of one still to come
+        for nested, sublist in reversed(nested_lists):
+            for i, element in enumerate(self._instance_loop(nested.loop, sublist, nested.key)):
+                loop_instance.insert(nested.index + i, element)
+        for paragraph in hidden_paragraphs:
+            loop_instance.remove(paragraph)
+        return loop_instance.getchildren()
+
+    def _get_all_keys_in_list_of_dicts(self, mylist, name):
+        if not isinstance(mylist, list):
+            raise TemplateError("[%s] has a loop in %s, so it has to be a list in the resume"
+                                % (name, self.template_filename))
         mykeys = set()
         for e in mylist:
+            if not isinstance(e, dict):
+                raise TemplateError("The entries of [%s] are repeated by a loop in %s, so each one "
+                                    "has to be a mapping of [tags] to values, not %r"
+                                    % (name, self.template_filename, e))
             for k in e.keys():
                 mykeys.add(k)
         return list(mykeys)
 
-    def _parse_xml(self):
-
-        body = self.doc_etree.xpath('/w:document/w:body', namespaces=self.nsprefixes)[0]
-        self._join_tags(body)
-        if self.skip:
-            return
-        # Get a list of all the top-level tags
-        tags = self._find_tags(self.doc_etree, self.resume_data.keys())
-        for section_name, node in tags.items():
-            logging.debug("Subtag search for %s" % section_name)
-            subtags = self._find_subtags_in_loop(node,self.resume_data[section_name])
-            logging.debug("Finished find_subtags_in_loop")
-        return
-
     def _itertext(self, my_etree):
         """Iterator to go through xml tree's text nodes"""
-        for node in my_etree.iter(tag=etree.Element):
-            if self._check_element_is(node, 't'):
-                yield (node, node.text)
-
-    def _itersiblingtext(self, my_etree):
-        """Iterator to go through xml tree sibling text nodes"""
-        # First, check if there are siblings, if not, we need to just go through the current element
-        if my_etree.getnext() is None:
-            for node in my_etree.iter(tag=etree.Element):
-                if self._check_element_is(node, 't'):
-                    yield (node, node.text, 0)
-        else:
-            for i, sib in enumerate(my_etree.itersiblings(tag=etree.Element)):
-                for node in sib.iter(tag=etree.Element):
-                    if self._check_element_is(node, 't'):
-                        yield (node, node.text, i)
+        for node in my_etree.iter(self.wtag['t']):
+            yield (node, node.text)
 
     def _join_tags(self, my_etree):
-        chars = []
-        openbrac = False
-        inside_openbrac_node = False
+        """
+            Word often splits a [tag] over several runs.  Move the text of
+            any tag split like that into the node holding its '[', and take
+            it out of the nodes after.
+
+            Only the bracket positions are visited (found with a regex), and
+            each node is assigned to at most once per tag it ends or carries.
+        """
+        openbrac_node = None        # Node with a '[' that isn't closed yet
+        inside_openbrac_node = False  # Tag was opened in the current node
+        chars = []                  # Text after the '[' from the nodes after openbrac_node
 
         for node,text in self._itertext(my_etree):
-            # Scan through every node with text
-            for i,c in enumerate(text):
-                # Go through each node's text character by character
-                if c == '[':
-                    openbrac = True # Within a tag
-                    inside_openbrac_node = True # Tag was opened in this node
+            if not text:
+                continue
+            for m in self.mBracket.finditer(text):
+                i = m.start()
+                if text[i] == '[':
                     openbrac_node = node # Save ptr to open bracket containing node
+                    inside_openbrac_node = True # Tag was opened in this node
                     chars = []
-                elif c== ']':
-                    assert openbrac
-                    if inside_openbrac_node:
-                        # Open and close inside same node, no need to do anything
-                        pass
-                    else:
-                        # Open bracket in earlier node, now it's closed
-                        # So append all the chars we've encountered since the openbrac_node '['
-                        # to the openbrac_node
-                        chars.append(']')
+                elif openbrac_node is None:
+                    # A ']' that isn't closing anything, leave it be
+                    continue
+                else:
+                    if not inside_openbrac_node:
+                        # Open bracket in earlier node, now it's closed.
+                        # So append all the chars we've seen since the '['
+                        # to the openbrac_node, and remove them from this node
+                        chars.append(text[:i+1])
                         openbrac_node.text += ''.join(chars)
-                        # Also, don't forget to remove the characters seen so far from current node
-                        node.text = text[i+1:] 
-                    openbrac = False
+                        node.text = text[i+1:]
+                    # else open and close inside same node, no need to do anything
+                    openbrac_node = None
                     inside_openbrac_node = False
-                else:
-                    # Normal text character
-                    if openbrac and inside_openbrac_node:
-                        # No need to copy text
-                        pass
-                    elif openbrac and not inside_openbrac_node:
-                        chars.append(c)
-                    else:
-                        # outside of a open/close
-                        pass
-            if openbrac and not inside_openbrac_node:
-                # Went through all text that is part of an open bracket/close bracket
-                # in other nodes
-                # need to remove this text completely
+                    chars = []
+            if openbrac_node is not None and not inside_openbrac_node:
+                # All the text in this node is part of a tag opened in an earlier node
+                chars.append(text)
                 node.text = ""
             inside_openbrac_node = False
 
-    def _get_doc_from_docx (self):
-        xml_content = self.zipfile.read('word/document.xml')
-        return etree.fromstring(xml_content)
+    def _read_raw_member(self, template_zip, info):
+        """ Return the still-compressed bytes of one member of the template zip
+        """
+        src = template_zip.fp
+        src.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, src.read(zipfile.sizeFileHeader))
+        # Skip past the local header's filename and extra fields to the data
+        fname_len, extra_len = header[-2], header[-1]
+        src.seek(fname_len + extra_len, os.SEEK_CUR)
+        return src.read(info.compress_size)
+
+    def write_docx (self, xml_content, output, pretty_print=False,
+                    compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        """ Create the new docx zip directly from the template's members.
+            Serialize the modified xml straight into word/document.xml, and
+            copy every other member over as its raw compressed bytes (no
+            decompress/recompress, no temp directory).
+
+            compression_level (0-9, or -1 for zlib's default) only applies
+            to word/document.xml; 0 stores it uncompressed.
+
+            output can be a filename or any writable file object (e.g. BytesIO)
+        """
+        self._write_zip(output, lambda f: etree.ElementTree(xml_content).write(f, pretty_print=pretty_print),
+                        compression_level)
 
-    def _write_and_close_docx (self, xml_content, output_filename):
-        """ Create a temp directory, expand the original docx zip.
-            Write the modified xml to word/document.xml
-            Zip it up as the new docx
+    def _write_zip(self, output, write_document, compression_level):
+        """ Write the docx, with write_document(f) writing the xml of
+            word/document.xml to the binary file object f
         """
+        with timing.stage('zip_write'), zipfile.ZipFile(output, "w") as docx:
+            for info, raw_bytes in self.members:
+                if info.filename == 'word/document.xml':
+                    with timing.stage('serialization'):
+                        self._write_document(docx, info, write_document, compression_level)
+                else:
+                    self._write_raw_member(docx, info, raw_bytes)
 
-        tmp_dir = tempfile.mkdtemp()
+    def _write_document(self, docx, info, write_document, compression_level):
+        """ Add the member info to docx, compressing the xml as write_document
+            produces it rather than building the whole string first
+        """
+        doc_info = zipfile.ZipInfo(info.filename, info.date_time)
+        if compression_level == 0:
+            doc_info.compress_type = zipfile.ZIP_STORED
+        else:
+            doc_info.compress_type = info.compress_type
+        doc_info.external_attr = info.external_attr
+        # The CRC and sizes aren't known until the end, so they go in a
+        # data descriptor after the data instead of in the local header
+        doc_info.flag_bits |= 0x08
+        doc_info.header_offset = docx.fp.tell()
+        docx.fp.write(doc_info.FileHeader())
+
+        writer = _MemberWriter(docx.fp, doc_info.compress_type, compression_level)
+        write_document(writer)
+        writer.close()
+
+        doc_info.CRC = writer.crc & 0xffffffff
+        doc_info.compress_size = writer.compress_size
+        doc_info.file_size = writer.file_size
+        docx.fp.write(struct.pack('<4sLLL', b'PK\x07\x08', doc_info.CRC,
+                                  doc_info.compress_size, doc_info.file_size))
+        self._add_to_directory(docx, doc_info)
+
+    def _write_raw_member(self, docx, info, raw_bytes):
+        """ Add one already-compressed member to docx
+        """
+        new_info = copy.copy(info)
+        # Sizes and CRC go in the local header, so no trailing data descriptor
+        new_info.flag_bits &= ~0x08
+        new_info.header_offset = docx.fp.tell()
+        docx.fp.write(new_info.FileHeader())
+        docx.fp.write(raw_bytes)
+        self._add_to_directory(docx, new_info)
+
+    def _add_to_directory(self, docx, new_info):
+        """ Record a member written straight to docx.fp, for the central directory
+        """
+        docx.filelist.append(new_info)
+        docx.NameToInfo[new_info.filename] = new_info
+        docx._didModify = True
+        if hasattr(docx, 'start_dir'):
+            # Python 3 writes the central directory at start_dir
+            docx.start_dir = docx.fp.tell()
+
+
+class _MemberWriter(object):
+    """
+        Binary file object that compresses what's written to it onto the
+        end of an open zip file, keeping the CRC and sizes for the member
+    """
+
+    def __init__(self, fp, compress_type, compression_level):
+        self.fp = fp
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        if compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+        else:
+            self.compressor = None
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self._write_compressed(data)
 
-        self.zipfile.extractall(tmp_dir)
+    def close(self):
+        if self.compressor:
+            self._write_compressed(self.compressor.flush())
 
-        with open(os.path.join(tmp_dir,'word/document.xml'), 'w') as f:
-            xmlstr = etree.tostring (xml_content, pretty_print=True)
-            f.write(xmlstr)
+    def _write_compressed(self, data):
+        self.compress_size += len(data)
+        self.fp.write(data)
 
-        # Get a list of all the files in the original docx zipfile
-        filenames = self.zipfile.namelist()
 
-        # Now, create the new zip file and add all the filex into the archive
-        zip_copy_filename = output_filename
-        with zipfile.ZipFile(zip_copy_filename, "w") as docx:
-            for filename in filenames:
-                docx.write(os.path.join(tmp_dir,filename), filename)
+class WordResume(Plugin):
+
+    template_file_extension = 'docx'
+    version = 2
 
-        # Clean up the temp dir
-        shutil.rmtree(tmp_dir)
+    def __init__ (self, template_file, resume_data, skip, options=None):
+        options = options or {}
+        self.skip = skip
+        # Pretty-printing makes the xml bigger, so it's only on by default
+        # when writing the template back out as is
+        self.pretty_print = bool(options.get('pretty_print', skip))
+        self.compression_level = int(options.get('compression_level', zlib.Z_DEFAULT_COMPRESSION))
+        # Write the loops out as they're instanced instead of building the whole document
+        self.streaming = bool(options.get('streaming', False))
+        self.resume_data = resume_data
+        self.template_filename = template_file
+        self.template = self.load_template(self.template_filename)
 
+    @classmethod
+    def load_template(cls, template_file):
+        return CompiledWordTemplate.load(template_file)
 
+    def render(self, output_filename):
+        if self.streaming:
+            self.template.write_docx_streaming(self.resume_data, output_filename, self.skip,
+                                               self.compression_level)
+            return
+        with timing.stage('loop_expansion'):
+            doc_etree = self.template.render(self.resume_data, self.skip, self.render_cache)
+        self.template.write_docx(doc_etree, output_filename, self.pretty_print,
+                                 self.compression_level)
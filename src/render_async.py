@@ -0,0 +1,126 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Render resumes from asyncio code (Python 3 only).
+
+        renderer = AsyncRenderer(max_workers=4, max_concurrency=16)
+        docx_bytes = await renderer.render({'format': 'Word',
+                                            'template': 'resume.docx',
+                                            'resume': resume_dict})
+
+    Jobs take the same keys as a request to the render server (see
+    oneresume.handle_request).  The lxml/Mako work runs on a thread pool, so
+    every render shares the plugins' template caches, and concurrent jobs
+    for a template that isn't loaded yet wait on a single load of it.
+
+    Cancelling a job that is still queued stops it from running.  One that
+    has already started on a thread runs to the end, and its result is
+    dropped.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from plugin import Plugin
+from oneresume import RenderError, PLUGINS_DIR, get_plugin, load_resume
+
+
+def _load_plugins():
+    if not Plugin.available:
+        Plugin.load(PLUGINS_DIR)
+
+
+class AsyncRenderer(object):
+
+    def __init__(self, max_workers=4, max_concurrency=None, executor=None):
+        """
+            Renders run on executor, or a new pool of max_workers threads.
+            At most max_concurrency jobs (default max_workers) are taken
+            on at once; the rest wait their turn without using a thread.
+        """
+        _load_plugins()
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+        self.max_concurrency = max_concurrency or max_workers
+        self._semaphore = None
+        # (format, template path) -> future of the plugin class, while it loads
+        self._loading = {}
+
+    async def render(self, job):
+        """
+            Render job, returning the document bytes, or the output filename
+            if the job has an 'output'
+        """
+        for key in ('format', 'template'):
+            if key not in job:
+                raise RenderError("Job is missing '%s'" % key)
+        if 'resume' not in job and 'data' not in job:
+            raise RenderError("Job has neither 'data' nor 'resume'")
+
+        if self._semaphore is None:
+            # Made here so it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            plugin = await self._load(job['format'], job['template'])
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, self._render, plugin, job)
+
+    async def _load(self, fmt, template_file):
+        """
+            Import the plugin and load its template once, however many jobs
+            ask for it at the same time
+        """
+        key = (fmt, os.path.realpath(template_file))
+        future = self._loading.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self.executor, self._load_template, fmt, template_file)
+            self._loading[key] = future
+            # Later jobs find the template in the plugin's own cache
+            future.add_done_callback(lambda f: self._loading.pop(key, None))
+        # One job being cancelled mustn't cancel the load for the others
+        return await asyncio.shield(future)
+
+    def _load_template(self, fmt, template_file):
+        plugin = get_plugin(fmt, template_file)
+        plugin.load_template(template_file)
+        return plugin
+
+    def _render(self, plugin, job):
+        if 'resume' in job:
+            resume = job['resume']
+        else:
+            resume = load_resume(job['data'])
+        text = plugin(job['template'], resume, job.get('skip', False), job.get('options'))
+        if job.get('output'):
+            text.render(job['output'])
+            return job['output']
+        return text.render_bytes()
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_default_renderer = None
+
+async def render_async(job):
+    """
+        Render job (see AsyncRenderer.render) with a renderer shared by the
+        whole process
+    """
+    global _default_renderer
+    if _default_renderer is None:
+        _default_renderer = AsyncRenderer()
+    return await _default_renderer.render(job)
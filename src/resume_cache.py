@@ -0,0 +1,113 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Cache of parsed resume YAML files.
+
+    Entries are keyed by the file's path, mtime and size, so an edited file
+    is always re-read.  Optionally the parsed tree is also pickled into a
+    cache directory so later runs can skip YAML parsing altogether.
+"""
+
+import os
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import yaml
+
+# Use libyaml's C parser when it's been built
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+class ResumeCache(object):
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        # For renders run on threads (see render_async)
+        self.lock = threading.Lock()
+
+    def load(self, data_filename):
+        """
+            Return the parsed resume in data_filename.  The same object is
+            handed to every caller, so it must not be modified.
+        """
+        st = os.stat(data_filename)
+        key = (os.path.realpath(data_filename), st.st_mtime, st.st_size)
+
+        with self.lock:
+            if key in self.entries:
+                # Move to the end, as the most recently used
+                resume = self.entries.pop(key)
+            else:
+                resume = self._load_from_disk_cache(key)
+                if resume is None:
+                    with open(data_filename) as resume_file:
+                        resume = load_yaml(resume_file)
+                    self._save_to_disk_cache(key, resume)
+                if len(self.entries) >= self.max_entries:
+                    self.entries.popitem(last=False)
+            self.entries[key] = resume
+        return resume
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _get_pickle_filename(self, key):
+        key_hash = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'data', key_hash + '.pickle')
+
+    def _load_from_disk_cache(self, key):
+        if not self.cache_dir:
+            return None
+        pickle_filename = self._get_pickle_filename(key)
+        if not os.path.exists(pickle_filename):
+            return None
+        try:
+            with open(pickle_filename, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logging.warning("Ignoring unreadable cache file %s: %s" % (pickle_filename, e))
+            return None
+
+    def _save_to_disk_cache(self, key, resume):
+        if not self.cache_dir:
+            return
+        pickle_filename = self._get_pickle_filename(key)
+        pickle_dir = os.path.dirname(pickle_filename)
+        if not os.path.isdir(pickle_dir):
+            try:
+                os.makedirs(pickle_dir)
+            except OSError:
+                # Another process may have just made it
+                if not os.path.isdir(pickle_dir):
+                    raise
+        # Write to a per-process temp name, so parallel jobs never see a half-written file
+        tmp_filename = '%s.%d.tmp' % (pickle_filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(resume, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, pickle_filename)
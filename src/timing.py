@@ -0,0 +1,68 @@
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Opt-in timing of the stages of a render.
+
+    Code marks a stage with
+
+        with timing.stage('join_tags'):
+            ...
+
+    which does nothing unless a recording has been started in this process
+    with timing.start().  Stages can nest (e.g. join_tags happens inside
+    template_load when a template is compiled), and a stage that runs more
+    than once in a recording is added up.
+"""
+
+import timeit
+from contextlib import contextmanager
+from collections import OrderedDict
+
+timer = timeit.default_timer
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.stages = OrderedDict()  # Stage name -> seconds
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+
+# The Timings being recorded in this process, if any
+_current = None
+
+def start():
+    global _current
+    _current = Timings()
+    return _current
+
+def stop():
+    global _current
+    timings, _current = _current, None
+    return timings
+
+@contextmanager
+def stage(name):
+    if _current is None:
+        yield
+        return
+    timings = _current
+    start_time = timer()
+    try:
+        yield
+    finally:
+        timings.add(name, timer() - start_time)